@@ -1,37 +1,77 @@
 # analysis/llm_analyzer.py
+import io
 import requests
-import json
-from typing import List, Dict
+import orjson
+from typing import List, Dict, Callable, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import config
 
-def build_analysis_context(similar_samples: List[Dict], features: Dict) -> str:
-    """Build a rich context string for the LLM.
+def _build_session() -> requests.Session:
+    """Create a pooled HTTP session for talking to the Ollama API.
 
-    The context is the heart of the Retrieval-Augmented Generation (RAG) process. We are giving the LLM
-    "retrieved" information to augment its analysis.
+    Reusing one session keeps the TCP connection to Ollama alive between calls instead
+    of paying a new handshake (and a new connection pool) for every request.
     """
-    context = "# Similar Malware Samples from Database:\n\n"
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        # POST is not retried by default; Ollama chat requests are safe to resend.
+        max_retries=Retry(
+            total=config.LLM_MAX_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["POST"])
+        )
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-    for i, sample in enumerate(similar_samples, 1):
-        context += f"## Sample {i} (Similarity: {sample['score']:.3f})\n"
-        context += f"Source: {sample['metadata'].get('file', 'Unknown')}\n"
-        context += f"```\n{sample['text'][:500]}...\n```\n\n"
-        if sample['metadata'].get('api_calls'):
-            context += f"Suspicious APIs: {', '.join(sample['metadata']['api_calls'])}\n"
-        context += "\n"
-
-    context += "## Extracted Features from Target Sample\n\n"
-    context += f"**Suspicious API Calls:** {', '.join(features.get('api_calls', ['None detected']))}\n"
-    context += f"**Network Operations:** {', '.join(features.get('network_operations', ['None detected']))}\n"
-    context += f"**Cryptographic Operations:** {', '.join(features.get('crypto_operations', ['None detected']))}\n"
-    
-    return context
+# Prefix of the message returned instead of an analysis when the LLM cannot be reached.
+LLM_ERROR_PREFIX = "Error communicating with LLM"
 
-def analyze_with_llm(user_code: str, context: str) -> str:
-    """Analyze code using RAG and an LLM."""
-    
-    system_prompt = """You are an elite malware reverse engineer. Your analysis must include:
+# A single session shared by every LLM call in the process (analysis, batch analysis and red team chat).
+_SESSION = _build_session()
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+def post_chat(payload: Dict, on_chunk: Optional[Callable[[str], None]] = None) -> Dict:
+    """Send a streaming chat payload to Ollama over the shared session and return the reply message.
+
+    Ollama streams the reply as one JSON object per line. Each piece of text is passed to
+    `on_chunk` as soon as it arrives, and the pieces are joined into the returned message.
+    """
+    chunks = []
+    # The timeout is a (connect, read) tuple: fail fast if Ollama is unreachable,
+    # but give the model plenty of time to generate its answer.
+    timeout = (config.LLM_CONNECT_TIMEOUT, config.LLM_READ_TIMEOUT)
+    # orjson serializes large prompts much faster than the stdlib `json` used by `requests`.
+    body = orjson.dumps(payload)
+    with _SESSION.post(config.OLLAMA_URL, data=body, headers=_JSON_HEADERS, stream=True,
+                       timeout=timeout) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            try:
+                data = orjson.loads(line)
+            except orjson.JSONDecodeError as e:
+                # A truncated or garbled stream is a transport failure, like a dropped connection.
+                raise requests.RequestException(f"Invalid response line from Ollama: {line[:200]!r}") from e
+            if 'error' in data:
+                raise requests.RequestException(data['error'])
+            content = data.get('message', {}).get('content', '')
+            if content:
+                chunks.append(content)
+                if on_chunk:
+                    on_chunk(content)
+    return {"role": "assistant", "content": "".join(chunks)}
+
+# The prompts are the same for every analysis, so they are built once at import time.
+_SYSTEM_PROMPT = """You are an elite malware reverse engineer. Your analysis must include:
 1. **Executive Summary**: High-level threat assessment.
 2. **Behavioral Analysis**: What the code does.
 3. **Malicious Techniques**: Specific TTPs (map to MITRE ATT&CK).
@@ -39,35 +79,69 @@ def analyze_with_llm(user_code: str, context: str) -> str:
 5. **Detection Rules**: YARA rule snippets.
 Be thorough and technical."""
 
-    user_prompt = f"""# Code to Analyze:
+_USER_TMPL = """# Code to Analyze:
 ```
-{user_code}
+{code}
 ```
 
 {context}
 
 Provide a comprehensive malware analysis based on the code and the similar samples from our database."""
 
+def build_analysis_context(similar_samples: List[Dict], features: Dict) -> str:
+    """Build a rich context string for the LLM.
+
+    The context is the heart of the Retrieval-Augmented Generation (RAG) process. We are giving the LLM
+    "retrieved" information to augment its analysis.
+    """
+    # Writing into a StringIO buffer keeps assembly linear instead of re-copying a growing string.
+    buf = io.StringIO()
+    w = buf.write
+    w("# Similar Malware Samples from Database:\n\n")
+
+    for i, sample in enumerate(similar_samples, 1):
+        w(f"## Sample {i} (Rank score: {sample['score']:.3f})\n")
+        w(f"Source: {sample['metadata'].get('file', 'Unknown')}\n")
+        w(f"```\n{sample.get('snippet') or sample['text'][:500]}...\n```\n\n")
+        apis = sample['metadata'].get('api_calls')
+        if apis:
+            w(f"Suspicious APIs: {', '.join(apis)}\n")
+        w("\n")
+
+    w("## Extracted Features from Target Sample\n\n")
+    w(f"**Suspicious API Calls:** {features.get('api_calls_str', 'None detected')}\n")
+    w(f"**Network Operations:** {features.get('network_operations_str', 'None detected')}\n")
+    w(f"**Cryptographic Operations:** {features.get('crypto_operations_str', 'None detected')}\n")
+    
+    return buf.getvalue()
+
+def analyze_with_llm(user_code: str, context: str, on_chunk: Optional[Callable[[str], None]] = None) -> str:
+    """Analyze code using RAG and an LLM.
+
+    If `on_chunk` is given, it receives the analysis text piece by piece while the LLM generates it.
+    """
+    
+    user_prompt = _USER_TMPL.format(code=user_code, context=context)
+
     # The Ollama API expects the conversation as a list of message dictionaries.
     # Each dictionary has a "role" (system, user, or assistant) and "content".
     messages = [
-        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": _SYSTEM_PROMPT},
         {"role": "user", "content": user_prompt}
     ]
     
     payload = {
         "model": config.LLM_MODEL,
         "messages": messages,
-        "stream": False, # We set stream to False to get the full response at once, not in chunks.
+        "stream": True, # Stream the response in chunks so text can be used as soon as it is generated.
         "options": {
             "temperature": 0.3, # Lower temperature = more deterministic, less creative responses.
-            "num_ctx": config.LLM_CONTEXT_SIZE
+            "num_ctx": config.LLM_CONTEXT_SIZE,
+            "num_predict": config.LLM_MAX_OUTPUT_TOKENS # Upper bound on the number of generated tokens.
         }
     }
     
     try:
-        response = requests.post(config.OLLAMA_URL, json=payload, timeout=3000)
-        response.raise_for_status()
-        return response.json()['message']['content']
+        return post_chat(payload, on_chunk)['content']
     except requests.RequestException as e:
-        return f"Error communicating with LLM: {e}"
+        return f"{LLM_ERROR_PREFIX}: {e}"
@@ -1,31 +1,82 @@
 # analysis/orchestrator.py
-import numpy as np
+import hashlib
 from pathlib import Path
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Callable, Optional, TYPE_CHECKING
 
 import config
-from retrieval.search import MalwareSearch
 from ingestion.preprocessing import extract_code_features
 from analysis import query_router, yara_generator, llm_analyzer
+from analysis.rag_cache import RAGCache
+
+# `retrieval.search` pulls in sentence-transformers (and torch); it is only needed here for type hints.
+if TYPE_CHECKING:
+    from retrieval.search import MalwareSearch
+
+# A small shared pool for the independent steps of an analysis (embedding, feature extraction).
+# Embedding and the vector search release the GIL while they wait on torch/numpy or the network.
+_POOL = ThreadPoolExecutor(max_workers=4)
+
+def _digest16(text: str) -> int:
+    """Return a 16-bit BLAKE2b digest of a string.
+
+    Unlike the built-in `hash`, this does not change between Python processes.
+    """
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8', errors='ignore'), digest_size=2).digest(), "big")
 
 class ComprehensiveMalwareAnalyzer:
     """Orchestrates the full malware analysis workflow."""
 
-    def __init__(self, search_engine: MalwareSearch):
+    def __init__(self, search_engine: 'MalwareSearch'):
         self.search_engine = search_engine
+        self.cache = RAGCache(
+            maxsize=config.RAG_CACHE_SIZE,
+            ttl=config.RAG_CACHE_TTL,
+            similarity_threshold=config.RAG_CACHE_SIMILARITY
+        )
 
-    def full_analysis_report(self, suspicious_code: str, include_yara: bool = True) -> str:
-        """Generate a comprehensive analysis report."""
+    def full_analysis_report(self, suspicious_code: str, include_yara: bool = True,
+                             on_chunk: Optional[Callable[[str], None]] = None,
+                             source: str = "") -> str:
+        """Generate a comprehensive analysis report.
+
+        If `on_chunk` is given, it receives the report text piece by piece as it is produced.
+        `source` labels the sample in the cache, so a report reused for a near-duplicate says
+        which sample it was written for.
+        """
         print("[*] Starting comprehensive malware analysis...")
 
+        # Embedding the code and extracting its features don't depend on each other or on the
+        # malware type, so they run in the background while the query is routed.
+        print("[*] Extracting indicators of compromise...")
+        features_future = _POOL.submit(extract_code_features, suspicious_code)
+        # The code embedding is used both for the cache lookup and for the similarity search.
+        embedding_future = _POOL.submit(self.search_engine.embed, suspicious_code)
+
         malware_type = query_router.route_query(suspicious_code)
         print(f"[+] Detected malware type: {malware_type}")
 
-        print("[*] Searching for similar malware samples...")
-        similar_samples = self.search_engine.hybrid_search(suspicious_code, top_k=10)
+        code_embedding = embedding_future.result()
+        # Including the model in the group invalidates cached reports when the LLM changes.
+        cache_group = (malware_type, config.LLM_MODEL, include_yara)
+        cache_key = RAGCache.make_key(suspicious_code, cache_group)
+        cached = self.cache.get(cache_key, code_embedding, cache_group)
+        if cached is not None:
+            cached_report = cached.report
+            if cached.key == cache_key:
+                print("[+] Found a cached analysis for this sample.")
+            else:
+                # Never pass off another sample's analysis as this one's: say where it came from.
+                print(f"[+] Reusing the analysis of a near-duplicate sample ({cached.source}, similarity {cached.similarity:.3f}).")
+                cached_report = (f"> Reused analysis of a near-duplicate sample "
+                                 f"(similarity {cached.similarity:.3f}, source: {cached.source}).\n\n" + cached_report)
+            if on_chunk:
+                on_chunk(cached_report)
+            return cached_report
 
-        print("[*] Extracting indicators of compromise...")
-        features = extract_code_features(suspicious_code)
+        print("[*] Searching for similar malware samples...")
+        similar_samples = self.search_engine.hybrid_search(suspicious_code, top_k=10, query_embedding=code_embedding)
+        features = features_future.result()
 
         yara_rule = ""
         # We only generate a rule if the user wants one
@@ -41,26 +92,50 @@ class ComprehensiveMalwareAnalyzer:
             context += f"\n## Auto-Generated YARA Rule\n```yara\n{yara_rule}\n```"
 
         print("[*] Generating detailed analysis with LLM...")
-        analysis = llm_analyzer.analyze_with_llm(suspicious_code, context)
+        analysis = llm_analyzer.analyze_with_llm(suspicious_code, context, on_chunk)
+
+        # Don't cache failed LLM calls, so the next attempt gets a real analysis.
+        if not analysis.startswith(llm_analyzer.LLM_ERROR_PREFIX):
+            self.cache.put(cache_key, code_embedding, cache_group, analysis, source)
 
         return analysis
 
+    def _analyze_and_save(self, i: int, total: int, code: str, output_path: Path):
+        """Analyze a single batch sample and stream its report to disk."""
+        print(f"\n{'='*60}\nAnalyzing sample {i}/{total}\n{'='*60}")
+        # A short, stable hexadecimal digest of the code makes the filename unique and identical across runs.
+        report_file = output_path / f"report_{i}_{_digest16(code):04x}.md"
+        if report_file.exists():
+            print(f"[+] Report already exists, skipping: {report_file}")
+            return
+        # The report is written to a temporary file while the LLM generates it, and only
+        # renamed to its final name once the analysis succeeded.
+        partial_file = report_file.with_suffix(".md.part")
+        # Use a try...except block to ensure that if one sample fails, the whole batch process doesn't stop.
+        try:
+            with open(partial_file, 'w', encoding='utf-8') as f:
+                f.write(f"# Malware Analysis Report - Sample {i}\n\n")
+                report = self.full_analysis_report(code, on_chunk=f.write, source=report_file.name)
+            if report.startswith(llm_analyzer.LLM_ERROR_PREFIX):
+                raise RuntimeError(report)
+            partial_file.replace(report_file)
+            print(f"[+] Report saved to: {report_file}")
+        except Exception as e:
+            partial_file.unlink(missing_ok=True)
+            print(f"[!] Error analyzing sample {i}: {e}")
+
     def batch_analysis(self, code_samples: List[str], output_dir: str = "./analysis_reports"):
-        """Analyze multiple samples and save reports."""
+        """Analyze multiple samples concurrently and save reports."""
         output_path = Path(output_dir)
         output_path.mkdir(exist_ok=True)
 
-        for i, code in enumerate(code_samples, 1):
-            print(f"\n{'='*60}\nAnalyzing sample {i}/{len(code_samples)}\n{'='*60}")
-            # Use a try...except block to ensure that if one sample fails, the whole batch process doesn't stop.
-            try:
-                report = self.full_analysis_report(code)
-                # `hash(code) & 0xFFFF:04x` creates a short, hexadecimal hash of the code to make the filename unique.
-                report_file = output_path / f"report_{i}_{hash(code) & 0xFFFF:04x}.md"
-                with open(report_file, 'w', encoding='utf-8') as f:
-                    f.write(f"# Malware Analysis Report - Sample {i}\n\n")
-                    f.write(report)
-                print(f"[+] Report saved to: {report_file}")
-            except Exception as e:
-                print(f"[!] Error analyzing sample {i}: {e}")
-
+        # Samples are analyzed in parallel, at most `LLM_CONCURRENCY` at a time, so retrieval,
+        # feature extraction and waiting on the LLM overlap across samples. Every worker goes
+        # through `llm_analyzer.post_chat`, so they all share the same pooled connections to Ollama.
+        with ThreadPoolExecutor(max_workers=config.LLM_CONCURRENCY) as pool:
+            futures = [
+                pool.submit(self._analyze_and_save, i, len(code_samples), code, output_path)
+                for i, code in enumerate(code_samples, 1)
+            ]
+            for future in futures:
+                future.result()
@@ -1,33 +1,45 @@
 # analysis/query_router.py
+import ahocorasick
+
+# Keyword rules for each malware category, in priority order: when keywords from several
+# categories appear in the code, the category listed first wins.
+_RULES = (
+    ("ransomware", ('encrypt', 'ransom', 'bitcoin', '.locked')),
+    ("rats", ('keylog', 'screenshot', 'clipboard', 'rat')),
+    # Rootkits operate at a low level of the operating system.
+    ("rootkits", ('kernel', 'driver', 'rootkit', 'ssdt')),
+    # Cryptocurrency miners steal CPU resources.
+    ("cryptominers", ('mining', 'xmrig', 'monero', 'stratum')),
+    # Botnets are networks of infected machines.
+    ("botnets", ('bot', 'ddos', 'irc', 'command')),
+    # Infostealers steal passwords, cookies, and other credentials.
+    ("infostealers", ('password', 'cookie', 'credential', 'wallet')),
+)
+
+def _build_automaton() -> ahocorasick.Automaton:
+    """Compile every keyword into one Aho-Corasick automaton tagged with (priority, category)."""
+    automaton = ahocorasick.Automaton()
+    # Iterate in reverse so that a keyword shared by several categories keeps its highest priority.
+    for priority, (category, terms) in reversed(list(enumerate(_RULES))):
+        for term in terms:
+            automaton.add_word(term, (priority, category))
+    automaton.make_automaton()
+    return automaton
+
+_AUTOMATON = _build_automaton()
 
 def route_query(code: str) -> str:
     """Intelligently route queries to specialized indexes based on keywords.
 
     This is a simple heuristic-based router. It checks for the presence of certain
-    keywords to make an educated guess about the malware's category.
+    keywords to make an educated guess about the malware's category. All keywords are
+    matched in a single pass over the code using the prebuilt automaton.
     """
-    code_lower = code.lower()
-    
-    if any(term in code_lower for term in ['encrypt', 'ransom', 'bitcoin', '.locked']):
-        return "ransomware"
-    
-    if any(term in code_lower for term in ['keylog', 'screenshot', 'clipboard', 'rat']):
-        return "rats"
-
-    # Checks for terms related to rootkits, which operate at a low level of the operating system.
-    if any(term in code_lower for term in ['kernel', 'driver', 'rootkit', 'ssdt']):
-        return "rootkits"
-
-    # Checks for terms related to cryptocurrency miners, which steal CPU resources.
-    if any(term in code_lower for term in ['mining', 'xmrig', 'monero', 'stratum']):
-        return "cryptominers"
-
-    # Checks for terms related to botnets, which are networks of infected machines.
-    if any(term in code_lower for term in ['bot', 'ddos', 'irc', 'command']):
-        return "botnets"
-
-    # Checks for terms related to infostealers, which steal passwords, cookies, and other credentials.
-    if any(term in code_lower for term in ['password', 'cookie', 'credential', 'wallet']):
-        return "infostealers"
-    
-    return "general"
\ No newline at end of file
+    best = (len(_RULES), "general")
+    for _, match in _AUTOMATON.iter(code.lower()):
+        if match < best:
+            best = match
+            # Nothing can beat the highest-priority category, so stop scanning early.
+            if best[0] == 0:
+                break
+    return best[1]
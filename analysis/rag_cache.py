@@ -0,0 +1,91 @@
+# analysis/rag_cache.py
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+
+class CacheHit(NamedTuple):
+    """A cached report, with the key and label of the sample it was generated for."""
+    report: str
+    key: str
+    source: str
+    similarity: float
+
+class RAGCache:
+    """An in-memory LRU cache of analysis reports with an exact and a semantic tier.
+
+    Exact hits are keyed on the SHA-256 of the code plus a `group` tuple (e.g. malware type and LLM model).
+    Near hits compare the code embedding with the embeddings of cached reports (cosine similarity),
+    so near-duplicate samples reuse a report instead of paying for another LLM generation.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600, similarity_threshold: float = 0.95):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        # key -> (timestamp, group, normalized embedding, report, source label), oldest first.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(code: str, group: Tuple) -> str:
+        """Build the exact-match key for a piece of code within a group."""
+        digest = hashlib.sha256(code.encode('utf-8', errors='ignore')).hexdigest()
+        return f"{digest}:{':'.join(map(str, group))}"
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _evict_expired(self, now: float):
+        expired = [key for key, (ts, _, _, _, _) in self._entries.items() if now - ts > self.ttl]
+        for key in expired:
+            del self._entries[key]
+
+    def get(self, key: str, embedding, group: Tuple) -> Optional[CacheHit]:
+        """Return the cached report for an exact or near-duplicate match, or None on a miss.
+
+        Near hits are only taken from entries stored with the same `group`. The returned hit
+        carries the key and source label of the sample the report was written for, so callers
+        can tell a near hit (`hit.key != key`) apart from an exact one.
+        """
+        with self._lock:
+            self._evict_expired(time.time())
+
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                entry = self._entries[key]
+                return CacheHit(entry[3], key, entry[4], 1.0)
+
+            candidates = [(k, entry) for k, entry in self._entries.items() if entry[1] == group]
+            if not candidates:
+                return None
+
+            # A single matrix-vector product scores the query against every cached embedding.
+            matrix = np.stack([entry[2] for _, entry in candidates])
+            scores = matrix @ self._normalize(embedding)
+            best = int(scores.argmax())
+            if scores[best] < self.similarity_threshold:
+                return None
+
+            best_key = candidates[best][0]
+            self._entries.move_to_end(best_key)
+            entry = self._entries[best_key]
+            return CacheHit(entry[3], best_key, entry[4], float(scores[best]))
+
+    def put(self, key: str, embedding, group: Tuple, report: str, source: str = ""):
+        """Store a report, evicting the least recently used entry when the cache is full.
+
+        `source` is a human-readable label for the sample (e.g. its report file), shown when
+        the report is reused for a near-duplicate.
+        """
+        with self._lock:
+            self._entries[key] = (time.time(), group, self._normalize(embedding), report, source or key[:12])
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
@@ -1,15 +1,16 @@
 # analysis/redteam_chat.py
 
+import functools
 import requests
-import json
 from typing import List, Dict
 
-from sentence_transformers import SentenceTransformer
-from ingestion.vector_db import VectorDB
-from retrieval.search import MalwareSearch
+from analysis.llm_analyzer import post_chat
 
 import config
 
+# Inputs that end the chat session.
+_EXIT_COMMANDS = frozenset(("exit", "quit", "q", ":q"))
+
 def build_rag_context_for_chat(similar_samples: List[Dict]) -> str:
     """Builds a simple context string for the chat prompt."""
     if not similar_samples:
@@ -17,7 +18,7 @@ def build_rag_context_for_chat(similar_samples: List[Dict]) -> str:
 
     context = "\n--- Relevant Information from Malware Database ---\n"
     for i, sample in enumerate(similar_samples, 1):
-        context += f"\nSource {i}: {sample['metadata'].get('file', 'Unknown')} (Similarity: {sample['score']:.2f})\n"
+        context += f"\nSource {i}: {sample['metadata'].get('file', 'Unknown')} (Rank score: {sample['score']:.2f})\n"
         text_snippet = sample.get('text', '')
         if not text_snippet:
             api_calls = sample['metadata'].get('api_calls')
@@ -30,6 +31,52 @@ def build_rag_context_for_chat(similar_samples: List[Dict]) -> str:
     context += "---------------------------------------------\n"
     return context
 
+def _content_plain(user_input: str) -> str:
+    """Use the user's message as is."""
+    return user_input
+
+def _content_with_rag(search_engine, user_input: str) -> str:
+    """Append relevant samples from the malware database to the user's message."""
+    print("[*] Searching database for context...")
+    similar_samples = search_engine.hybrid_search(user_input, top_k=3)
+    context_str = build_rag_context_for_chat(similar_samples)
+    return f"""{user_input}
+{context_str}"""
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the number of tokens in a text (about 4 characters per token)."""
+    return len(text) // 4 + 1
+
+def trim_history(messages: List[Dict], token_budget: int) -> List[Dict]:
+    """Drop the oldest exchanges until the conversation fits in the token budget.
+
+    Like `window_history`, this keeps the system prompt and the first exchange pinned, so the head of
+    the conversation (and Ollama's cached prefix) stays the same between turns. The latest message is
+    always kept, and older exchanges are dropped as whole user/assistant pairs. The first exchange is
+    only dropped if the conversation still doesn't fit without it.
+    """
+    total = sum(estimate_tokens(m['content']) for m in messages)
+    head, tail = messages[:3], messages[3:]
+    start = 0
+    # The last message of the tail is the latest one, so only the pairs before it can go.
+    while total > token_budget and start + 2 < len(tail):
+        total -= estimate_tokens(tail[start]['content']) + estimate_tokens(tail[start + 1]['content'])
+        start += 2
+    if total > token_budget and tail:
+        head = head[:1]
+    return head + tail[start:]
+
+def window_history(messages: List[Dict], max_turns: int) -> List[Dict]:
+    """Keep the system prompt and the first exchange, plus only the last `max_turns` exchanges.
+
+    Keeping the head of the conversation fixed lets Ollama reuse its cached prefix between turns,
+    while the rolling window stops the prompt from growing with every turn.
+    """
+    head, tail = messages[:3], messages[3:]
+    if len(tail) > 2 * max_turns:
+        tail = tail[-2 * max_turns:]
+    return head + tail
+
 def redteam_chat_session():
     """
     Initiates an interactive chat session with the LLM in a 'Red Team' persona,
@@ -39,8 +86,13 @@ def redteam_chat_session():
     print("[*] Initializing RAG components for Red Team mode...")
     search_engine = None
     try:
-        db = VectorDB()
-        code_embedder = SentenceTransformer(config.CODE_EMBEDDER_MODEL)
+        # These imports load torch and the Qdrant client, so they are deferred until a session starts.
+        from ingestion.embedder import get_embedder
+        from ingestion.vector_db import get_db
+        from retrieval.search import MalwareSearch
+
+        db = get_db()
+        code_embedder = get_embedder(config.CODE_EMBEDDER_MODEL)
         search_engine = MalwareSearch(client=db.get_client(), code_embedder=code_embedder)
         print("[+] RAG components ready.")
     except Exception as e:
@@ -66,49 +118,56 @@ Ensure all suggested methods are sophisticated, realistic, and align with the go
 Do not provide generic or well-known examples. Focus on novel and creative ideas."""
 
     messages = [{"role": "system", "content": system_prompt}]
+    system_prompt_tokens = estimate_tokens(system_prompt)
     
+    # Decide once whether turns are augmented with RAG context, instead of checking on every turn.
+    if search_engine:
+        build_user_content = functools.partial(_content_with_rag, search_engine)
+    else:
+        build_user_content = _content_plain
+
     print("\n--- Red Team Interactive Mode (RAG Enabled) ---")
     print("Chat with the LLM. Type 'exit' or 'quit' to end the session.")
     
     while True:
         try:
             user_input = input("> ")
-            if user_input.lower() in ['exit', 'quit']:
+            if user_input.strip().lower() in _EXIT_COMMANDS:
                 print("Exiting Red Team mode.")
                 break
 
-            final_user_content = user_input
-            if search_engine:
-                print("[*] Searching database for context...")
-                similar_samples = search_engine.hybrid_search(user_input, top_k=3)
-                context_str = build_rag_context_for_chat(similar_samples)
-                
-                final_user_content = f"""{user_input}
-{context_str}"""
-
-            messages.append({"role": "user", "content": final_user_content})
+            messages.append({"role": "user", "content": build_user_content(user_input)})
+            messages = trim_history(messages, config.LLM_CONTEXT_SIZE - config.LLM_MAX_OUTPUT_TOKENS)
             
             payload = {
                 "model": config.LLM_MODEL,
                 "messages": messages,
-                "stream": False,
+                "stream": True,
+                # Keep the model (and its cached prompt prefix) loaded between turns.
+                "keep_alive": config.LLM_KEEP_ALIVE,
                 "options": {
                     "temperature": 0.7, # Higher temperature for more creative/diverse responses
-                    "num_ctx": config.LLM_CONTEXT_SIZE
+                    "num_ctx": config.LLM_CONTEXT_SIZE,
+                    "num_predict": config.LLM_MAX_OUTPUT_TOKENS,
+                    # Never evict the system prompt from the context when it overflows.
+                    "num_keep": system_prompt_tokens
                 }
             }
             
-            response = requests.post(config.OLLAMA_URL, json=payload, timeout=3000)
-            response.raise_for_status()
-            
-            llm_response = response.json()['message']
-            print(f"\n{llm_response['content']}\n")
+            # Print the reply as it is generated instead of waiting for the full answer.
+            print()
+            llm_response = post_chat(payload, on_chunk=lambda text: print(text, end='', flush=True))
+            print("\n")
             
             messages.append(llm_response)
+            messages = window_history(messages, config.REDTEAM_HISTORY_TURNS)
 
         except requests.RequestException as e:
             print(f"Error communicating with LLM: {e}")
+            # Drop the unanswered message, so the history stays whole user/assistant pairs
+            # (the pinned head in `trim_history` and `window_history` relies on it).
+            if messages[-1]['role'] == 'user':
+                messages.pop()
         except (KeyboardInterrupt, EOFError):
             print("\nExiting Red Team mode.")
             break
-            break
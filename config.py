@@ -4,17 +4,73 @@ CODE_EMBEDDER_MODEL = 'microsoft/codebert-base'
 TEXT_EMBEDDER_MODEL = 'BAAI/bge-large-en-v1.5'
 
 QDRANT_URL = "http://localhost:6333"
+# Qdrant's gRPC port, used by the client for faster bulk uploads and searches.
+QDRANT_GRPC_PORT = 6334
+# How long (in seconds) a Qdrant request may take before it fails.
+QDRANT_TIMEOUT = 60
 CODE_COLLECTION = "malware_code"
+# The name of the sparse vector of feature keywords stored with each code point, used by hybrid search.
+KEYWORD_VECTOR_NAME = "keywords"
 TEXT_COLLECTION = "malware_docs"
 # This number specifies the size (dimensionality) of the vectors produced by the CODE_EMBEDDER_MODEL. It must match the model's output.
 CODE_EMBEDDING_DIM = 768
 TEXT_EMBEDDING_DIM = 1024
+# HNSW index settings for the collections. HNSW_M is the number of links per node and
+# HNSW_EF_CONSTRUCT the candidate list size used while building the index; both trade build time
+# and memory for recall. HNSW_EF_SEARCH is the candidate list size of each search.
+HNSW_M = 24
+HNSW_EF_CONSTRUCT = 128
+HNSW_EF_SEARCH = 100
+# How many texts are sent through an embedding model in one forward pass during ingestion.
+EMBEDDING_BATCH_SIZE = 128
+# Without a GPU, run the embedding models as INT8-quantized ONNX models, which encode several times
+# faster on the CPU. ONNX_QUANTIZATION is the target instruction set ("avx512_vnni", "avx512", "avx2"
+# or "arm64"), and the exported models are kept in ONNX_MODEL_DIR.
+ONNX_CPU_EMBEDDER = True
+ONNX_QUANTIZATION = "avx512_vnni"
+ONNX_MODEL_DIR = ".onnx_models"
+# SQLite file caching embeddings between ingestion runs, so unchanged chunks are not embedded again.
+EMBED_CACHE_PATH = ".embed_cache.sqlite"
+# SQLite file caching the feature keyword matches of each file (by content hash) between ingestion runs.
+FEATURE_CACHE_PATH = ".feature_cache.sqlite"
 
 OLLAMA_URL = "http://localhost:11434/api/chat"
 LLM_MODEL = "dolphin3:latest"
 # This sets the maximum "context size" for the LLM, which is the amount of text (in tokens) it can consider at once.
 # A larger context allows for more detailed prompts and analysis.
 LLM_CONTEXT_SIZE = 8192
+# The maximum number of tokens the LLM may generate in a single reply. This stops runaway generations
+# and leaves room in the context window for the prompt.
+LLM_MAX_OUTPUT_TOKENS = 2048
+# Timeouts (in seconds) for LLM requests: how long to wait for a connection to Ollama,
+# and how long to wait for the next piece of the response once connected.
+LLM_CONNECT_TIMEOUT = 10
+LLM_READ_TIMEOUT = 300
+# How many times a failed LLM request is retried (with exponential backoff) before giving up.
+LLM_MAX_RETRIES = 3
+# How long Ollama keeps the model loaded after a chat request (-1 keeps it loaded indefinitely).
+LLM_KEEP_ALIVE = -1
+# The number of recent question/answer exchanges kept in the red team chat history,
+# in addition to the system prompt and the first exchange.
+REDTEAM_HISTORY_TURNS = 6
+# The maximum number of samples analyzed at the same time in batch mode.
+# Each in-flight sample holds one connection to Ollama while it waits for the LLM.
+LLM_CONCURRENCY = 4
+
+# Settings for the analysis report cache. A cached report is reused when the same code is analyzed
+# again, or when a new sample's code embedding has at least RAG_CACHE_SIMILARITY cosine similarity
+# with an already analyzed one. Entries expire after RAG_CACHE_TTL seconds.
+RAG_CACHE_SIZE = 1024
+RAG_CACHE_TTL = 3600
+RAG_CACHE_SIMILARITY = 0.95
+
+# Settings for the vector search cache. A search reuses the results of an earlier search whose query
+# embedding has at least QUERY_CACHE_SIMILARITY cosine similarity with it, for up to QUERY_CACHE_TTL seconds.
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_TTL = 300
+QUERY_CACHE_SIMILARITY = 0.97
+# The number of recent query embeddings kept in memory, so code that is searched again isn't re-encoded.
+QUERY_EMBEDDING_CACHE_SIZE = 1024
 
 # A list of strings representing Windows API functions that are often used by malware.
 # For example, "CreateRemoteThread" can be used to inject code into another process.
@@ -35,6 +91,10 @@ CODE_EXTENSIONS = {'.c', '.cpp', '.h', '.hpp', '.py', '.asm', '.s',
                    '.vbs', '.ps1', '.bat', '.cmd', '.js'}
 BINARY_EXTENSIONS = {'.exe', '.dll', '.sys', '.so', '.dylib'}
 DOC_EXTENSIONS = {'.txt', '.md', '.pdf'}
+# Compressed, compiled and media files. Their high-entropy contents have nothing to chunk or match,
+# so ingestion skips them without reading them.
+SKIP_EXTENSIONS = frozenset({'.gz', '.zip', '.7z', '.rar', '.xz', '.bz2', '.jpg', '.jpeg', '.png',
+                             '.gif', '.mp4', '.mp3', '.pyc'})
 
 # A list of known malware family names.
 # This can be used by helper functions to tag samples based on their file path.
@@ -1,105 +1,264 @@
 # ingestion/data_loader.py
 import hashlib
-import uuid
-from pathlib import Path
-from typing import List
-from qdrant_client.models import PointStruct
+import itertools
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from typing import Any, Dict, Iterator, List, Tuple
+import numpy as np
 from sentence_transformers import SentenceTransformer
 
 import config
 from ingestion.vector_db import VectorDB
-from ingestion.preprocessing import chunk_code_file, analyze_binary, chunk_text_file
+from ingestion.embed_cache import EmbedCache
+from ingestion.embedder import embedder_variant, get_embedder
+from ingestion.preprocessing import FILE_HANDLERS, Chunk, file_extension, keyword_indices, preprocess_batch
+
+# How many chunks are buffered (across files) before they are embedded together.
+ENCODE_BUFFER_SIZE = 256
+# How many points are collected before they are uploaded to Qdrant.
+UPSERT_BATCH_SIZE = 1000
+# The maximum number of uploads running in the background before ingestion waits for one to finish.
+MAX_PENDING_UPSERTS = 4
+# How many files a worker process preprocesses per task. Sending files in small groups spreads the
+# cost of each round trip to a worker (pickling, queueing, waking it up) over several files.
+PREPROCESS_BATCH_SIZE = 16
+
+def _encode_texts(embedder: SentenceTransformer, texts: List[str], cache: EmbedCache) -> np.ndarray:
+    """Encode a list of texts, reusing cached embeddings and batching the unique remaining texts.
+
+    Returns a float16 array with one embedding row per text. Half precision halves the memory
+    held by buffered points and matches how the collections store their vectors.
+    """
+    if not texts:
+        return np.empty((0, 0), dtype=np.float16)
+
+    keys = [cache.key(text) for text in texts]
+    cached = cache.get_many(keys)
+
+    # Identical texts (license headers, boilerplate) share a key, so each one is only embedded once.
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in cached:
+            missing.setdefault(key, text)
+
+    if missing:
+        # Normalized (unit-length) embeddings make Qdrant's cosine distance a plain dot product.
+        new_vectors = embedder.encode(
+            list(missing.values()), batch_size=config.EMBEDDING_BATCH_SIZE, convert_to_numpy=True,
+            normalize_embeddings=True, show_progress_bar=False
+        )
+        cache.put_many(zip(missing, new_vectors))
+        cached.update(zip(missing, new_vectors))
+
+    return np.stack([cached[key] for key in keys]).astype(np.float16, copy=False)
+
+def _point_id(text: str) -> int:
+    """Derive a stable 64-bit point ID from a chunk's text.
+
+    Identical chunks always get the same ID, whichever file they are read from first, so repeated
+    runs update one point instead of adding copies. Qdrant stores unsigned integer IDs in 8 bytes,
+    instead of the 36-character string of a UUID.
+    """
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8', errors='ignore'), digest_size=8).digest(), 'little')
+
+class _CollectionWriter:
+    """Buffers chunks for one collection, embeds them in batches and uploads the points in the background."""
+
+    def __init__(self, collection: str, embedder: SentenceTransformer, cache: EmbedCache,
+                 db: VectorDB, upload_pool: ThreadPoolExecutor, keyword_vectors: bool = False):
+        self.collection = collection
+        self.embedder = embedder
+        self.cache = cache
+        self.db = db
+        self.upload_pool = upload_pool
+        # Whether each point also gets a sparse vector of the feature keywords in its payload.
+        self.keyword_vectors = keyword_vectors
+        # (point id, text, payload) tuples waiting to be embedded.
+        self.pending = []
+        # Embedded points waiting to be uploaded, kept as parallel lists plus numpy vector blocks.
+        self.ids = []
+        self.payloads = []
+        self.vectors = []
+        self.uploads = deque()
+        # Point ids of the chunks added so far, to skip exact duplicates (license headers, shared
+        # stubs, copies of the same sample). Point ids are digests of the chunk text, so they double
+        # as fingerprints.
+        self.seen = set()
+        # Point id of a first copy -> locations ({file, chunk_index}) of its skipped duplicates.
+        self.duplicates = {}
+
+    def add(self, text: str, payload: Dict[str, Any]):
+        point_id = _point_id(text)
+        if point_id in self.seen:
+            # The first copy is already stored with an identical vector, so this one is neither
+            # embedded nor uploaded; only where it was found is recorded on the first copy.
+            location = {field: payload[field] for field in ("file", "chunk_index") if field in payload}
+            self.duplicates.setdefault(point_id, []).append(location)
+            return
+        self.seen.add(point_id)
+        self.pending.append((point_id, text, payload))
+        if len(self.pending) >= ENCODE_BUFFER_SIZE:
+            self._encode_pending()
+
+    def _encode_pending(self):
+        if not self.pending:
+            return
+        self.vectors.append(_encode_texts(self.embedder, [text for _, text, _ in self.pending], self.cache))
+        for point_id, _, payload in self.pending:
+            self.ids.append(point_id)
+            self.payloads.append(payload)
+        self.pending = []
+        if len(self.ids) >= UPSERT_BATCH_SIZE:
+            self._upload()
+
+    def _take_points(self) -> Dict[str, Any]:
+        """Return the buffered points as `upload_points` arguments, and start a new buffer."""
+        points = {"ids": self.ids, "vectors": np.concatenate(self.vectors), "payloads": self.payloads}
+        if self.keyword_vectors:
+            points["keyword_indices"] = [keyword_indices(payload) for payload in self.payloads]
+        print(f"Inserting {len(self.ids)} points into {self.collection}")
+        self.ids, self.payloads, self.vectors = [], [], []
+        return points
+
+    def _upload(self):
+        if not self.ids:
+            return
+        # Bound the number of in-flight uploads so a slow database applies backpressure.
+        while len(self.uploads) >= MAX_PENDING_UPSERTS:
+            self.uploads.popleft().result()
+        self.uploads.append(self.upload_pool.submit(self.db.upload_points, self.collection, **self._take_points()))
+
+    def close(self):
+        """Embed and upload everything that is still buffered, then wait for all uploads."""
+        self._encode_pending()
+        while self.uploads:
+            self.uploads.popleft().result()
+        # The last batch is sent after all the others and waits until Qdrant has applied it. Updates
+        # are applied in order, so every earlier (unacknowledged) batch is then applied too.
+        if self.ids:
+            self.db.upload_points(self.collection, **self._take_points(), wait=True)
+        if self.duplicates:
+            # Every point is applied by now, so the duplicate locations can be attached to them.
+            self.db.record_duplicates(self.collection, self.duplicates)
+            skipped = sum(len(locations) for locations in self.duplicates.values())
+            print(f"Skipped {skipped} duplicate chunks in {self.collection}")
+
+def _batched(items: Iterator[str], size: int) -> Iterator[List[str]]:
+    """Group an iterator's items into lists of at most `size` items."""
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+def _iter_files(root: str) -> Iterator[str]:
+    """Yield the path of every file under `root` that has a preprocessing handler.
+
+    `os.walk` gets file types from the directory listing itself, so unlike `Path.rglob` plus
+    `is_file` it doesn't need a `stat()` call (or a `Path` object) per entry.
+    """
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            # Unsupported files are dropped here, before they cost a round trip to a worker process.
+            if file_extension(name) in FILE_HANDLERS:
+                yield os.path.join(dirpath, name)
+
+def _worker_context() -> multiprocessing.context.BaseContext:
+    """Return the multiprocessing context for the preprocessing workers.
+
+    By the time the pool starts, this process runs torch and tokenizer threads and holds an open
+    gRPC channel, and forking a process with live threads like these can hang the child. Workers
+    are started by a forkserver (or spawned where that isn't available) instead. The forkserver
+    imports only the preprocessing module, so workers never load sentence-transformers.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["ingestion.preprocessing"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+def _iter_preprocessed(repo_path: str, pool: ProcessPoolExecutor) -> Iterator[Tuple[str, str, List[Chunk]]]:
+    """Preprocess files in worker processes and yield (file_path, kind, chunks) as they complete.
+
+    Files are sent to the workers in groups of `PREPROCESS_BATCH_SIZE`. Only a bounded number of
+    groups is in flight at a time, so a huge repository is never materialized in memory and the
+    main thread always has work ready for the embedders. Results are consumed in completion order,
+    so one slow group (e.g. with a large PE binary) doesn't hold back the groups queued behind it.
+    """
+    in_flight = set()
+    max_in_flight = 4 * (os.cpu_count() or 1)
+    try:
+        for batch in _batched(_iter_files(repo_path), PREPROCESS_BATCH_SIZE):
+            in_flight.add(pool.submit(preprocess_batch, batch))
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        for future in as_completed(in_flight):
+            yield from future.result()
+        in_flight = set()
+    finally:
+        # Stop pending work if the consumer stopped early (e.g. max_files was reached).
+        for future in in_flight:
+            future.cancel()
 
 def ingest_vx_repository(repo_path: str, db: VectorDB, max_files: int = None):
-    """Ingest the VX-Underground repository into the vector store."""
-    repo = Path(repo_path)
-    if not repo.exists():
+    """Ingest the VX-Underground repository into the vector store.
+
+    Reading and chunking files runs in a pool of worker processes, embedding runs on the main
+    thread, and Qdrant uploads run in background threads, so the three stages overlap.
+    """
+    if not os.path.isdir(repo_path):
         print(f"Error: Repository path not found at {repo_path}")
         return
 
-    code_embedder = SentenceTransformer(config.CODE_EMBEDDER_MODEL)
-    text_embedder = SentenceTransformer(config.TEXT_EMBEDDER_MODEL)
-    qdrant_client = db.get_client()
-    
+    code_embedder = get_embedder(config.CODE_EMBEDDER_MODEL)
+    text_embedder = get_embedder(config.TEXT_EMBEDDER_MODEL)
+    # The backend/precision variant is part of the cache key, so vectors from e.g. the INT8 ONNX
+    # model are never served to a run that uses the fp16 GPU model.
+    variant = embedder_variant()
+    code_cache = EmbedCache(config.EMBED_CACHE_PATH, f"{config.CODE_EMBEDDER_MODEL}|{variant}")
+    text_cache = EmbedCache(config.EMBED_CACHE_PATH, f"{config.TEXT_EMBEDDER_MODEL}|{variant}")
     file_count = 0
-    code_points = []
-    text_points = []
 
     print("Scanning VX-Underground repository...")
-    
-    for file_path in repo.rglob('*'):
-        if not file_path.is_file():
-            continue
-        
-        if max_files and file_count >= max_files:
-            break
-        
-        suffix = file_path.suffix.lower()
-        
-        if suffix in config.CODE_EXTENSIONS:
-            chunks = chunk_code_file(file_path)
-            for idx, chunk in enumerate(chunks):
-                embedding = code_embedder.encode(chunk["text"])
-                point = PointStruct(
-                    id=str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{file_path}_{idx}")),
-                    vector=embedding.tolist(),
-                    payload={**chunk["metadata"], "chunk_index": idx, "type": "code"}
-                )
-                code_points.append(point)
-                
-                if len(code_points) >= 1000:
-                    qdrant_client.upsert(collection_name=config.CODE_COLLECTION, points=code_points)
-                    print(f"Inserted {len(code_points)} code chunks")
-                    code_points = []
-            
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=_worker_context()) as pool, \
+            ThreadPoolExecutor(max_workers=2) as upload_pool:
+        code_writer = _CollectionWriter(config.CODE_COLLECTION, code_embedder, code_cache, db, upload_pool,
+                                        keyword_vectors=True)
+        text_writer = _CollectionWriter(config.TEXT_COLLECTION, text_embedder, text_cache, db, upload_pool)
+
+        for file_path, kind, chunks in _iter_preprocessed(repo_path, pool):
+            if max_files and file_count >= max_files:
+                break
+
+            if kind == "code":
+                for idx, chunk in enumerate(chunks):
+                    code_writer.add(
+                        chunk.text,
+                        {**chunk.metadata, "text": chunk.text, "chunk_index": idx, "type": "code"}
+                    )
+            elif kind == "binary":
+                chunk = chunks[0]
+                code_writer.add(chunk.text, {"file": file_path, "type": "binary", **chunk.metadata})
+            elif kind == "document":
+                for idx, chunk in enumerate(chunks):
+                    text_writer.add(
+                        chunk.text,
+                        {**chunk.metadata, "text": chunk.text, "chunk_index": idx, "type": "document"}
+                    )
+            else:
+                continue
+
             file_count += 1
             if file_count % 100 == 0:
                 print(f"Processed {file_count} files...")
 
-        elif suffix in config.BINARY_EXTENSIONS or not suffix:
-            binary_features = analyze_binary(file_path)
-            # Skip binaries with no extracted features
-            if not binary_features["imports"] and not binary_features["exports"]:
-                continue
+        code_writer.close()
+        text_writer.close()
 
-            feature_text = f"""
-            File: {file_path.name}
-            Imports: {', '.join(binary_features['imports'][:50])}
-            Exports: {', '.join(binary_features['exports'][:20])}
-            Suspicious: {', '.join(binary_features['suspicious_characteristics'])}
-            """
-            embedding = code_embedder.encode(feature_text)
-            point = PointStruct(
-                id=str(uuid.uuid5(uuid.NAMESPACE_DNS, str(file_path))),
-                vector=embedding.tolist(),
-                payload={"file": str(file_path), "type": "binary", **binary_features}
-            )
-            code_points.append(point)
-            file_count += 1
+    code_cache.close()
+    text_cache.close()
 
-        elif suffix in config.DOC_EXTENSIONS:
-            if suffix in ['.txt', '.md']:
-                chunks = chunk_text_file(file_path)
-                for idx, chunk in enumerate(chunks):
-                    embedding = text_embedder.encode(chunk["text"])
-                    point = PointStruct(
-                        id=str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{file_path}_{idx}")),
-                        vector=embedding.tolist(),
-                        payload={**chunk["metadata"], "chunk_index": idx, "type": "document"}
-                    )
-                    text_points.append(point)
-
-                    if len(text_points) >= 1000:
-                        qdrant_client.upsert(collection_name=config.TEXT_COLLECTION, points=text_points)
-                        print(f"Inserted {len(text_points)} document chunks")
-                        text_points = []
-                file_count += 1
-
-    if code_points:
-        qdrant_client.upsert(collection_name=config.CODE_COLLECTION, points=code_points)
-        print(f"Inserted final {len(code_points)} points")
-    if text_points:
-        qdrant_client.upsert(collection_name=config.TEXT_COLLECTION, points=text_points)
-        print(f"Inserted final {len(text_points)} points")
-    
     print(f"Ingestion complete! Processed {file_count} files")
@@ -0,0 +1,46 @@
+# ingestion/embed_cache.py
+import hashlib
+import sqlite3
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+class EmbedCache:
+    """A persistent cache of embeddings keyed by a hash of the model name and the text.
+
+    Re-ingesting unchanged files then only embeds the chunks that actually changed.
+    Vectors are stored as float16 to halve the size of the cache on disk.
+    """
+
+    def __init__(self, path: str, model_name: str):
+        self.model_name = model_name
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+
+    def key(self, text: str) -> bytes:
+        """Return the cache key of a text for this cache's model."""
+        data = self.model_name.encode() + b'\0' + text.encode('utf-8', errors='ignore')
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """Look up several keys at once and return the vectors that were found."""
+        found = {}
+        # SQLite limits the number of parameters per query, so look keys up in slices.
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch)
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float16)
+        return found
+
+    def put_many(self, items: Iterable[Tuple[bytes, np.ndarray]]):
+        """Store several vectors in a single transaction."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                ((key, np.asarray(vector, dtype=np.float16).tobytes()) for key, vector in items)
+            )
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,39 @@
+# ingestion/feature_cache.py
+import sqlite3
+from typing import Optional, Tuple
+
+import numpy as np
+
+class FeatureCache:
+    """A persistent cache of the keyword matches found in a file, keyed by the file's hash.
+
+    Re-ingesting an unchanged file then skips the keyword scan. A match is stored as the line it is
+    on and the id of the keyword, which is all that is needed to rebuild each chunk's features.
+    """
+
+    def __init__(self, path: str):
+        # Every preprocessing worker opens its own connection. WAL mode lets them read while another
+        # one writes, and the timeout makes a writer wait for the lock instead of failing.
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS keyword_matches (key BLOB PRIMARY KEY, lines BLOB NOT NULL, keywords BLOB NOT NULL)"
+        )
+
+    def get(self, key: bytes) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Return the (lines, keyword ids) of the matches stored under `key`, or None on a miss."""
+        row = self.conn.execute("SELECT lines, keywords FROM keyword_matches WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.int32), np.frombuffer(row[1], dtype=np.int32)
+
+    def put(self, key: bytes, lines: np.ndarray, keyword_ids: np.ndarray):
+        """Store the matches of one file."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO keyword_matches (key, lines, keywords) VALUES (?, ?, ?)",
+                (key, np.asarray(lines, dtype=np.int32).tobytes(), np.asarray(keyword_ids, dtype=np.int32).tobytes())
+            )
+
+    def close(self):
+        self.conn.close()
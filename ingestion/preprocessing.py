@@ -1,90 +1,248 @@
 # ingestion/preprocessing.py
+import bisect
 import hashlib
+import itertools
+import mmap
+import os
+import re
+import sys
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, NamedTuple, Optional, Tuple
+import ahocorasick
+import numpy as np
 import pefile
 import config
+from ingestion.feature_cache import FeatureCache
+
+class Chunk(NamedTuple):
+    """A piece of a file to embed, with the metadata stored alongside it in the vector store.
+
+    A tuple is smaller than a dict and cheaper to send back from the worker processes; the
+    metadata stays a dict because it becomes the Qdrant payload.
+    """
+    text: str
+    metadata: Dict[str, Any]
+
+# The keyword lists behind each feature of `extract_code_features`, in output order.
+_FEATURE_KEYWORDS = (
+    ("api_calls", config.SUSPICIOUS_APIS),
+    ("network_operations", config.NETWORK_PATTERNS),
+    ("crypto_operations", config.CRYPTO_PATTERNS),
+)
+
+def _build_keyword_automaton() -> Tuple[ahocorasick.Automaton, List[List[Tuple[str, int, str]]]]:
+    """Compile all feature keywords into one case-insensitive Aho-Corasick automaton.
+
+    Each lowercased keyword maps to a keyword id, which indexes the list of the
+    (feature, position, keyword) entries it stands for.
+    """
+    automaton = ahocorasick.Automaton()
+    keyword_entries = []
+    for feature, keywords in _FEATURE_KEYWORDS:
+        for position, keyword in enumerate(keywords):
+            key = keyword.lower()
+            if key not in automaton:
+                automaton.add_word(key, len(keyword_entries))
+                keyword_entries.append([])
+            keyword_entries[automaton.get(key)].append((feature, position, keyword))
+    automaton.make_automaton()
+    return automaton, keyword_entries
+
+_KEYWORD_AUTOMATON, _KEYWORD_ENTRIES = _build_keyword_automaton()
+
+# The sparse vector index of each (feature, keyword) pair, in `_FEATURE_KEYWORDS` order.
+_KEYWORD_VECTOR_INDEX = {
+    (feature, keyword): index
+    for index, (feature, keyword) in enumerate(
+        (feature, keyword) for feature, keywords in _FEATURE_KEYWORDS for keyword in keywords
+    )
+}
+
+def keyword_indices(features: Dict[str, Any]) -> List[int]:
+    """Return the sparse vector indices of the keywords listed in a features dict (or a chunk's metadata).
+
+    The indices are fixed by the config keyword lists, so they mean the same thing in every process.
+    """
+    return sorted({
+        _KEYWORD_VECTOR_INDEX[(feature, keyword)]
+        for feature, _ in _FEATURE_KEYWORDS
+        for keyword in features.get(feature, ())
+        if (feature, keyword) in _KEYWORD_VECTOR_INDEX
+    })
+
+# Keyword ids depend on the keyword lists, so cached matches are only reused with the same lists.
+_KEYWORDS_DIGEST = hashlib.blake2b(repr(_FEATURE_KEYWORDS).encode('utf-8'), digest_size=8).digest()
+
+# Each preprocessing worker process opens its own connection to the feature cache on first use.
+_feature_cache: Optional[FeatureCache] = None
+
+def _get_feature_cache() -> FeatureCache:
+    global _feature_cache
+    if _feature_cache is None:
+        _feature_cache = FeatureCache(config.FEATURE_CACHE_PATH)
+    return _feature_cache
+
+# A simple heuristic to detect the start of a function in various languages. One precompiled
+# pattern tests every marker in a single call per line.
+_FUNCTION_DEF_RE = re.compile(r'def |function |sub |PROC|void |int main')
+
+# Files at least this large are memory-mapped instead of read into a buffer. For small files,
+# setting up the mapping costs more than it saves.
+MMAP_MIN_SIZE = 64 * 1024
+
+def _read_text(file_path: Path) -> Tuple[str, str]:
+    """Return the SHA-256 digest of a file's bytes and its text decoded as UTF-8.
+
+    Large files are hashed and decoded straight from a read-only memory map, so their bytes are
+    never copied into a separate buffer.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_MIN_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                file_hash = hashlib.sha256(mm).hexdigest()
+                content = str(mm, 'utf-8', 'ignore')
+        else:
+            raw = f.read()
+            file_hash = hashlib.sha256(raw).hexdigest()
+            content = raw.decode('utf-8', errors='ignore')
+    # Normalize line endings the way text mode (universal newlines) did.
+    return file_hash, content.replace('\r\n', '\n').replace('\r', '\n')
 
 def extract_code_features(code: str) -> Dict[str, Any]:
     """Extract semantic features from a code snippet by searching for keywords."""
-    features = {
-        "api_calls": [],
-        "network_operations": [],
-        "crypto_operations": []
-    }
-    code_lower = code.lower()
+    # One pass over the code finds every keyword of every feature at once.
+    found = set()
+    for _, keyword_id in _KEYWORD_AUTOMATON.iter(code.lower()):
+        found.update(_KEYWORD_ENTRIES[keyword_id])
+    return _features_from_matches(found)
 
-    for api in config.SUSPICIOUS_APIS:
-        if api.lower() in code_lower:
-            features["api_calls"].append(api)
+def _features_from_matches(found) -> Dict[str, Any]:
+    """Build the features dict from a set of matched (feature, position, keyword) entries."""
+    # Sorting by (feature, position) keeps each feature's keywords in the order of the config lists.
+    features = {feature: [] for feature, _ in _FEATURE_KEYWORDS}
+    for feature, _, keyword in sorted(found):
+        features[feature].append(keyword)
 
-    features["network_operations"] = [p for p in config.NETWORK_PATTERNS if p in code_lower]
-    features["crypto_operations"] = [p for p in config.CRYPTO_PATTERNS if p in code_lower]
+    # Ready-to-print summaries of each list, so report builders don't have to join them again.
+    for key in ("api_calls", "network_operations", "crypto_operations"):
+        features[f"{key}_str"] = ", ".join(features[key]) or "None detected"
     
     return features
 
-def chunk_code_file(file_path: Path) -> List[Dict[str, Any]]:
+def _line_starts(text: str) -> np.ndarray:
+    """Return the offset of every line of `text` (as split on '\\n'), plus `len(text) + 1` at the end.
+
+    The newlines are found by numpy in a single vectorized pass, not line by line in Python.
+    """
+    # `isascii` is a constant-time flag check; ASCII text can be viewed one byte per character.
+    if text.isascii():
+        codes = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+    else:
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    newlines = np.flatnonzero(codes == 10)
+    return np.concatenate(([0], newlines + 1, [len(text) + 1]))
+
+def _plan_chunks(line_count: int, function_def_lines: List[int]) -> Iterator[Tuple[int, int, int]]:
+    """Yield the (first_line, last_line, end_line) of each chunk.
+
+    A chunk ends at a line if:
+    1. That line has a function definition AND the chunk is then longer than 10 lines, OR
+    2. The chunk has reached a hard limit of 50 lines.
+    Any remaining lines form the last chunk, whose end line is the number of lines. Each boundary is
+    found with a binary search over the function definition lines, so this loops once per chunk
+    rather than once per line.
+    """
+    first = 0
+    while first < line_count:
+        last = first + 49
+        i = bisect.bisect_left(function_def_lines, first + 10)
+        if i < len(function_def_lines):
+            last = min(last, function_def_lines[i])
+        if last >= line_count:
+            yield first, line_count - 1, line_count
+            return
+        yield first, last, last
+        first = last + 1
+
+def _keyword_matches(file_hash: str, content: str, line_starts: np.ndarray) -> Tuple[List[int], List[int]]:
+    """Return the line and keyword id of every feature keyword match in a file, in line order.
+
+    The file is scanned once, instead of rescanning every chunk, and the matches are cached by the
+    file's hash, so an unchanged file is not scanned again on later ingestion runs.
+    """
+    cache = _get_feature_cache()
+    cache_key = _KEYWORDS_DIGEST + bytes.fromhex(file_hash)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        lines, keyword_ids = cached
+        return lines.tolist(), keyword_ids.tolist()
+
+    # Matches are located by their offset in the lowercased content (lowercasing can change the
+    # length of a line, but never the number of lines). Keywords never contain a newline, so each
+    # match belongs to exactly one line.
+    content_lower = content.lower()
+    match_ends = []
+    keyword_ids = []
+    for end, keyword_id in _KEYWORD_AUTOMATON.iter(content_lower):
+        match_ends.append(end)
+        keyword_ids.append(keyword_id)
+    lower_line_starts = line_starts if len(content_lower) == len(content) else _line_starts(content_lower)
+    lines = np.searchsorted(lower_line_starts, match_ends, side='right') - 1
+    cache.put(cache_key, lines, keyword_ids)
+    return lines.tolist(), keyword_ids
+
+def chunk_code_file(file_path: Path) -> List[Chunk]:
     """Chunk a single code file into smaller, more meaningful segments."""
     chunks = []
     try:
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
-        
-        lines = content.split('\n')
-        current_chunk_lines = []
-        chunk_start_line = 0
-        
-        for i, line in enumerate(lines):
-            current_chunk_lines.append(line)
-            
-            # This is a simple heuristic to detect the start of a function in various languages.
-            is_function_def = any(keyword in line for keyword in ['def ', 'function ', 'sub ', 'PROC', 'void ', 'int main'])
-            
-            # We decide to end the current chunk if:
-            # 1. We found a function definition AND the chunk is already longer than 10 lines, OR
-            # 2. The chunk has reached a hard limit of 50 lines.
-            if (is_function_def and len(current_chunk_lines) > 10) or len(current_chunk_lines) >= 50:
-                chunk_text = '\n'.join(current_chunk_lines)
-                chunks.append({
-                    "text": chunk_text,
-                    "metadata": {
-                        "file": str(file_path),
-                        "start_line": chunk_start_line,
-                        "end_line": i,
-                        "language": file_path.suffix,
-                        "size": len(chunk_text),
-                        "file_hash": hashlib.sha256(content.encode()).hexdigest(),
-                        **extract_code_features(chunk_text)
-                    }
-                })
-                current_chunk_lines = []
-                chunk_start_line = i + 1
-        
-        # After the loop, there might be remaining lines that didn't form a full chunk.
-        # This block ensures that the last part of the file is also saved as a chunk.
-        if current_chunk_lines:
-            chunk_text = '\n'.join(current_chunk_lines)
-            chunks.append({
-                "text": chunk_text,
-                "metadata": {
-                    "file": str(file_path),
-                    "start_line": chunk_start_line,
-                    "end_line": len(lines),
-                    "language": file_path.suffix,
-                    **extract_code_features(chunk_text)
+        # Hash the file once, from the bytes on disk, and share the digest between all its chunks.
+        file_hash, content = _read_text(file_path)
+        # Every chunk of the file shares the same string objects for these fields (which pickling
+        # back from the worker preserves); interning also shares them across files.
+        file_str = sys.intern(str(file_path))
+        language = sys.intern(file_path.suffix)
+
+        line_starts = _line_starts(content)
+        line_count = len(line_starts) - 1
+
+        match_lines, match_keywords = _keyword_matches(file_hash, content, line_starts)
+
+        # The lines containing a function definition, found with one regex sweep over the file.
+        # The markers never contain a newline either, so each match lies within one line.
+        def_offsets = [match.start() for match in _FUNCTION_DEF_RE.finditer(content)]
+        function_def_lines = np.unique(np.searchsorted(line_starts, def_offsets, side='right') - 1).tolist()
+
+        for first, last, end_line in _plan_chunks(line_count, function_def_lines):
+            # Chunks are sliced straight out of the file's text; no per-line strings are created.
+            chunk_text = content[line_starts[first]:line_starts[last + 1] - 1]
+            lo = bisect.bisect_left(match_lines, first)
+            hi = bisect.bisect_left(match_lines, last + 1)
+            chunks.append(Chunk(
+                text=chunk_text,
+                metadata={
+                    "file": file_str,
+                    "start_line": first,
+                    "end_line": end_line,
+                    "language": language,
+                    "size": len(chunk_text),
+                    "file_hash": file_hash,
+                    **_features_from_matches(set(itertools.chain.from_iterable(
+                        _KEYWORD_ENTRIES[keyword_id] for keyword_id in match_keywords[lo:hi]
+                    )))
                 }
-            })
+            ))
     except Exception as e:
         print(f"Error processing {file_path}: {e}")
     
     return chunks
 
-def chunk_text_file(file_path: Path) -> List[Dict[str, Any]]:
+def chunk_text_file(file_path: Path) -> List[Chunk]:
     """Chunk a single text file into paragraphs."""
     chunks = []
     try:
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
+        # Hash the file once, from the bytes on disk, and share the digest between all its chunks.
+        file_hash, content = _read_text(file_path)
+        file_str = sys.intern(str(file_path))
         
         # Split content by double newlines (paragraphs)
         paragraphs = content.split('\n\n')
@@ -94,19 +252,34 @@ def chunk_text_file(file_path: Path) -> List[Dict[str, Any]]:
                 continue
 
             chunk_text = para.strip()
-            chunks.append({
-                "text": chunk_text,
-                "metadata": {
-                    "file": str(file_path),
+            chunks.append(Chunk(
+                text=chunk_text,
+                metadata={
+                    "file": file_str,
                     "paragraph": i,
                     "size": len(chunk_text),
-                    "file_hash": hashlib.sha256(content.encode()).hexdigest(),
+                    "file_hash": file_hash,
                 }
-            })
+            ))
     except Exception as e:
         print(f"Error processing text file {file_path}: {e}")
     return chunks
 
+# The extensions of the PE files `analyze_binary` can parse. Other binaries yield no features.
+PE_EXTENSIONS = frozenset(('.exe', '.dll', '.sys'))
+
+def byte_entropy(data: bytes) -> float:
+    """Return the Shannon entropy of a byte string, in bits per byte (0.0 to 8.0).
+
+    Same result as pefile's `get_entropy()`, but the byte histogram and the logarithms are
+    computed by numpy instead of a Python loop over every byte.
+    """
+    if not data:
+        return 0.0
+    counts = np.bincount(np.frombuffer(data, dtype=np.uint8), minlength=256)
+    p = counts[counts > 0] / len(data)
+    return float(-(p * np.log2(p)).sum())
+
 def analyze_binary(file_path: Path) -> Dict[str, Any]:
     """Extract features from binary files like PE files using the pefile library."""
     features = {
@@ -117,37 +290,102 @@ def analyze_binary(file_path: Path) -> Dict[str, Any]:
     }
     try:
         # Only try to parse the file if it has a common PE file extension.
-        if file_path.suffix.lower() in ['.exe', '.dll', '.sys']:
-            pe = pefile.PE(str(file_path))
+        if file_path.suffix.lower() in PE_EXTENSIONS:
+            # Given a file name, pefile memory-maps the file itself instead of reading it into memory.
+            # `fast_load` skips every data directory; only the imports and exports are parsed afterwards,
+            # since resources, relocations, debug info, etc. are never used here. Sections are always parsed.
+            pe = pefile.PE(str(file_path), fast_load=True)
+            try:
+                pe.parse_data_directories(directories=[
+                    pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_IMPORT'],
+                    pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_EXPORT'],
+                ])
             
-            if hasattr(pe, 'DIRECTORY_ENTRY_IMPORT'):
-                for entry in pe.DIRECTORY_ENTRY_IMPORT:
-                    dll_name = entry.dll.decode('utf-8', errors='ignore')
-                    for imp in entry.imports:
-                        if imp.name: # The function might not have a name.
-                            func_name = imp.name.decode('utf-8', errors='ignore')
-                            features["imports"].append(f"{dll_name}::{func_name}")
+                if hasattr(pe, 'DIRECTORY_ENTRY_IMPORT'):
+                    for entry in pe.DIRECTORY_ENTRY_IMPORT:
+                        dll_name = entry.dll.decode('utf-8', errors='ignore')
+                        for imp in entry.imports:
+                            if imp.name: # The function might not have a name.
+                                func_name = imp.name.decode('utf-8', errors='ignore')
+                                features["imports"].append(f"{dll_name}::{func_name}")
             
-            if hasattr(pe, 'DIRECTORY_ENTRY_EXPORT'):
-                for exp in pe.DIRECTORY_ENTRY_EXPORT.symbols:
-                    if exp.name:
-                        features["exports"].append(exp.name.decode('utf-8', errors='ignore'))
+                if hasattr(pe, 'DIRECTORY_ENTRY_EXPORT'):
+                    for exp in pe.DIRECTORY_ENTRY_EXPORT.symbols:
+                        if exp.name:
+                            features["exports"].append(exp.name.decode('utf-8', errors='ignore'))
             
-            for section in pe.sections:
-                name = section.Name.decode('utf-8', errors='ignore').strip('\x00')
-                # `get_entropy()` calculates the entropy of the section's data. High entropy can indicate packed or encrypted code.
-                entropy = section.get_entropy()
-                features["sections"].append({
-                    "name": name,
-                    "virtual_size": section.Misc_VirtualSize,
-                    "entropy": entropy
-                })
-                # If entropy is very high (a common threshold is > 7.0 out of 8.0), flag it as suspicious.
-                if entropy > 7.0:
-                    features["suspicious_characteristics"].append(
-                        f"High entropy section: {name} ({entropy:.2f})"
-                    )
+                for section in pe.sections:
+                    name = section.Name.decode('utf-8', errors='ignore').strip('\x00')
+                    # The entropy of the section's data. High entropy can indicate packed or encrypted code.
+                    entropy = byte_entropy(section.get_data())
+                    features["sections"].append({
+                        "name": name,
+                        "virtual_size": section.Misc_VirtualSize,
+                        "entropy": entropy
+                    })
+                    # If entropy is very high (a common threshold is > 7.0 out of 8.0), flag it as suspicious.
+                    if entropy > 7.0:
+                        features["suspicious_characteristics"].append(
+                            f"High entropy section: {name} ({entropy:.2f})"
+                        )
+            finally:
+                # Release the file mapping right away instead of waiting for garbage collection.
+                pe.close()
     except Exception as e:
         print(f"Error analyzing binary {file_path}: {e}")
     
     return features
+
+def describe_binary(file_path: Path, binary_features: Dict[str, Any]) -> str:
+    """Summarize a binary's extracted features as text for the embedding model."""
+    # One line per field, without indentation, so no tokens are spent on whitespace.
+    return "\n".join((
+        "File: " + file_path.name,
+        "Imports: " + ", ".join(binary_features['imports'][:50]),
+        "Exports: " + ", ".join(binary_features['exports'][:20]),
+        "Suspicious: " + ", ".join(binary_features['suspicious_characteristics']),
+    ))
+
+def _preprocess_code(file_path: Path) -> Tuple[Optional[str], List[Chunk]]:
+    return "code", chunk_code_file(file_path)
+
+def _preprocess_binary(file_path: Path) -> Tuple[Optional[str], List[Chunk]]:
+    binary_features = analyze_binary(file_path)
+    # Skip binaries with no extracted features
+    if not binary_features["imports"] and not binary_features["exports"]:
+        return None, []
+    return "binary", [Chunk(text=describe_binary(file_path, binary_features), metadata=binary_features)]
+
+def _preprocess_document(file_path: Path) -> Tuple[Optional[str], List[Chunk]]:
+    return "document", chunk_text_file(file_path)
+
+# Lowercase file extension -> preprocessing handler. Later updates win, so code extensions take
+# precedence over binary and document ones.
+FILE_HANDLERS = {ext: _preprocess_document for ext in config.DOC_EXTENSIONS if ext in ('.txt', '.md')}
+# Only binaries `analyze_binary` can parse get a handler. Any other binary (including files without
+# an extension) would be read and then dropped for having no imports or exports.
+FILE_HANDLERS.update({ext: _preprocess_binary for ext in config.BINARY_EXTENSIONS if ext in PE_EXTENSIONS})
+FILE_HANDLERS.update({ext: _preprocess_code for ext in config.CODE_EXTENSIONS})
+# Compressed and media files are never worth chunking, even if an extension list above names them.
+for ext in config.SKIP_EXTENSIONS:
+    FILE_HANDLERS.pop(ext, None)
+
+def file_extension(file_path: str) -> str:
+    """Return the lowercase extension of a path, the key of `FILE_HANDLERS`."""
+    return os.path.splitext(file_path)[1].lower()
+
+def preprocess_file(file_path: str) -> Tuple[Optional[str], List[Chunk]]:
+    """Read and chunk a single file according to its extension.
+
+    Returns the kind of file ("code", "binary" or "document") and its chunks, or (None, []) if the
+    file is skipped. Ingestion runs this in worker processes, so it must not use the embedders or the database.
+    """
+    handler = FILE_HANDLERS.get(file_extension(file_path))
+    if handler is None:
+        return None, []
+    # The `Path` object is only created here, in the worker, instead of for every walked file.
+    return handler(Path(file_path))
+
+def preprocess_batch(file_paths: List[str]) -> List[Tuple[str, Optional[str], List[Chunk]]]:
+    """Preprocess a group of files in a worker process, returning (file_path, kind, chunks) for each."""
+    return [(file_path, *preprocess_file(file_path)) for file_path in file_paths]
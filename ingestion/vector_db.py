@@ -1,34 +1,149 @@
 # ingestion/vector_db.py
 from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams
+from qdrant_client.models import (
+    BinaryQuantization, BinaryQuantizationConfig, Datatype, Distance, HnswConfigDiff, OptimizersConfigDiff,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType, SetPayload, SetPayloadOperation, SparseVector,
+    SparseVectorParams, VectorParams
+)
+from typing import Any, Dict, List, Optional
+import threading
+import numpy as np
 import config
 
+# The number of points sent to Qdrant in one request.
+UPLOAD_BATCH_SIZE = 1024
+
+# The process-wide VectorDB, created on first use by `get_db`.
+_instance: Optional['VectorDB'] = None
+_instance_lock = threading.Lock()
+
+def has_keyword_vectors(client: QdrantClient, collection: str) -> bool:
+    """Return whether a collection stores the sparse keyword vectors used by hybrid search.
+
+    Collections created before they were added don't have them, and Qdrant can't add a new
+    vector to an existing collection.
+    """
+    sparse_vectors = client.get_collection(collection).config.params.sparse_vectors
+    return bool(sparse_vectors) and config.KEYWORD_VECTOR_NAME in sparse_vectors
+
 class VectorDB:
     def __init__(self):
         """
         Initializes the VectorDB client.
         """
-        self.client = QdrantClient(url=config.QDRANT_URL)
+        # gRPC sends vectors as packed protobuf instead of JSON, which is much cheaper for bulk uploads.
+        self.client = QdrantClient(url=config.QDRANT_URL, prefer_grpc=True, grpc_port=config.QDRANT_GRPC_PORT,
+                                   timeout=config.QDRANT_TIMEOUT)
         self._initialize_collections()
 
     def _initialize_collections(self):
         """Create vector store collections if they don't exist."""
+        # Quantized copies of the vectors are kept in RAM for searching, while the original
+        # vectors stay available for rescoring. INT8 shrinks the code vectors 4x; the larger
+        # 1024-dim text vectors are binarized (1 bit per dimension, 32x smaller).
         collections = {
-            config.CODE_COLLECTION: config.CODE_EMBEDDING_DIM,
+            config.CODE_COLLECTION: (
+                config.CODE_EMBEDDING_DIM,
+                # `quantile` ignores the most extreme 1% of values when choosing the INT8 range,
+                # so a few outliers don't cost precision for every other vector.
+                ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True)),
+                # Code points also get a sparse vector of their feature keywords, so hybrid search
+                # can match keywords inside Qdrant.
+                {config.KEYWORD_VECTOR_NAME: SparseVectorParams()}
+            ),
+            config.TEXT_COLLECTION: (
+                config.TEXT_EMBEDDING_DIM,
+                BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True)),
+                None
+            ),
         }
+
+        # One request lists the existing collections, instead of trying to create each one and
+        # treating the error as "already exists".
+        existing = {collection.name for collection in self.client.get_collections().collections}
         
-        for name, dim in collections.items():
-            try:
-                self.client.create_collection(
-                    collection_name=name,
-                    vectors_config=VectorParams(
-                        size=dim, # The vector dimension, which MUST match the embedding model.
-                        distance=Distance.COSINE # The similarity metric to use (Cosine Similarity is good for text/code).
-                    )
-                )
-                print(f"Created collection: {name}")
-            except Exception:
-                print(f"Collection {name} already exists or an error occurred.")
+        for name, (dim, quantization, sparse_vectors) in collections.items():
+            if name in existing:
+                print(f"Collection {name} already exists.")
+                continue
+            self.client.create_collection(
+                collection_name=name,
+                vectors_config=VectorParams(
+                    size=dim, # The vector dimension, which MUST match the embedding model.
+                    distance=Distance.COSINE, # The similarity metric to use (Cosine Similarity is good for text/code).
+                    # Store the original vectors in half precision; normalized embeddings lose no
+                    # meaningful accuracy at fp16, and the storage is halved.
+                    datatype=Datatype.FLOAT16
+                ),
+                quantization_config=quantization,
+                sparse_vectors_config=sparse_vectors,
+                hnsw_config=HnswConfigDiff(m=config.HNSW_M, ef_construct=config.HNSW_EF_CONSTRUCT),
+                # Segments larger than 20MB keep their original vectors memory-mapped on disk; searches
+                # traverse the quantized vectors in RAM and only read the originals for rescoring.
+                optimizers_config=OptimizersConfigDiff(memmap_threshold=20000)
+            )
+            print(f"Created collection: {name}")
+
+        self.keyword_vectors = has_keyword_vectors(self.client, config.CODE_COLLECTION)
+        if not self.keyword_vectors:
+            print(f"Collection {config.CODE_COLLECTION} has no keyword vectors; "
+                  "re-create it to enable keyword matching in hybrid search.")
+
+    def upload_points(self, collection: str, ids: List[int], vectors: np.ndarray,
+                      payloads: List[Dict[str, Any]], wait: bool = False,
+                      keyword_indices: Optional[List[List[int]]] = None):
+        """Upload points to a collection in batches of `UPLOAD_BATCH_SIZE`.
+
+        `upload_collection` takes the numpy vectors as they are, so no per-float Python lists are built.
+        With `wait=False` Qdrant acknowledges each batch before applying it, so batches are pipelined.
+        `keyword_indices` adds each point's sparse keyword vector (when the collection stores them).
+        """
+        if keyword_indices is not None and self.keyword_vectors:
+            # Named vectors have to be sent as lists; "" is the name of the collection's dense vector.
+            vectors = [
+                {"": vector.tolist(), config.KEYWORD_VECTOR_NAME: SparseVector(indices=indices, values=[1.0] * len(indices))}
+                if indices else {"": vector.tolist()}
+                for vector, indices in zip(vectors, keyword_indices)
+            ]
+        self.client.upload_collection(
+            collection_name=collection,
+            vectors=vectors,
+            payload=payloads,
+            ids=ids,
+            batch_size=UPLOAD_BATCH_SIZE,
+            wait=wait
+        )
+
+    def record_duplicates(self, collection: str, duplicates: Dict[int, List[Dict[str, Any]]]):
+        """Store where the skipped copies of each point were found, in its "duplicates" payload field.
+
+        The payload updates are sent in batches of `UPLOAD_BATCH_SIZE` operations and wait until
+        Qdrant has applied them.
+        """
+        operations = [
+            SetPayloadOperation(set_payload=SetPayload(payload={"duplicates": locations}, points=[point_id]))
+            for point_id, locations in duplicates.items()
+        ]
+        for start in range(0, len(operations), UPLOAD_BATCH_SIZE):
+            self.client.batch_update_points(
+                collection_name=collection,
+                update_operations=operations[start:start + UPLOAD_BATCH_SIZE],
+                wait=True
+            )
 
     def get_client(self):
-        return self.client
\ No newline at end of file
+        return self.client
+
+
+def get_db() -> VectorDB:
+    """Return this process's shared VectorDB, connecting and initializing the collections on first use.
+
+    The client's channel is thread-safe, so every caller can share the one connection.
+    """
+    global _instance
+    if _instance is None:
+        with _instance_lock:
+            # Another thread may have created it while we waited for the lock.
+            if _instance is None:
+                _instance = VectorDB()
+    return _instance
@@ -1,12 +1,9 @@
 # main.py
 import argparse
-from sentence_transformers import SentenceTransformer
 import config
-from ingestion.vector_db import VectorDB
-from ingestion.data_loader import ingest_vx_repository
-from retrieval.search import MalwareSearch
-from analysis.orchestrator import ComprehensiveMalwareAnalyzer
-from analysis.redteam_chat import redteam_chat_session
+
+# Each mode imports only the modules it uses, inside its own branch. The embedding and vector store
+# modules load torch, transformers and the Qdrant client, which takes seconds.
 
 def main():
     parser = argparse.ArgumentParser(description="Malware RAG Analysis and Red Team System")
@@ -24,8 +21,11 @@ def main():
     args = parser.parse_args()
 
     if args.mode == 'ingest':
+        from ingestion.data_loader import ingest_vx_repository
+        from ingestion.vector_db import get_db
+
         print("[*] Starting ingestion process...")
-        db = VectorDB()
+        db = get_db()
         ingest_vx_repository(
             repo_path=args.repo_path,
             db=db,
@@ -41,7 +41,9 @@ def main():
         print(f"[*] Analyzing file: {args.file}")
         
         try:
-            with open(args.file, 'r', encoding='utf-8') as f:
+            # Samples are often not clean UTF-8 (shellcode dumps, mixed encodings). Invalid bytes are
+            # replaced instead of failing the whole read.
+            with open(args.file, 'r', encoding='utf-8', errors='replace') as f:
                 suspicious_code = f.read()
         except FileNotFoundError:
             print(f"Error: Analysis file not found at {args.file}")
@@ -51,8 +53,13 @@ def main():
             return
 
         print("[*] Initializing analysis components...")
-        db = VectorDB()
-        code_embedder = SentenceTransformer(config.CODE_EMBEDDER_MODEL)
+        from analysis.orchestrator import ComprehensiveMalwareAnalyzer
+        from ingestion.embedder import get_embedder
+        from ingestion.vector_db import get_db
+        from retrieval.search import MalwareSearch
+
+        db = get_db()
+        code_embedder = get_embedder(config.CODE_EMBEDDER_MODEL)
         search_engine = MalwareSearch(client=db.get_client(), code_embedder=code_embedder)
         analyzer = ComprehensiveMalwareAnalyzer(search_engine=search_engine)
 
@@ -64,6 +71,8 @@ def main():
         print(report)
 
     elif args.mode == 'redteam':
+        from analysis.redteam_chat import redteam_chat_session
+
         redteam_chat_session()
 
     else:
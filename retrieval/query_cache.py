@@ -0,0 +1,91 @@
+# retrieval/query_cache.py
+import threading
+import time
+from typing import Dict, Hashable, List, Optional
+
+import numpy as np
+
+class QueryCache:
+    """A semantic LRU cache of vector search results.
+
+    A query whose embedding has at least `similarity_threshold` cosine similarity with a cached
+    query (searched with the same `group`, e.g. the same result limit) reuses its results instead
+    of going to Qdrant. Embeddings live in one preallocated matrix, so a lookup is a single
+    matrix-vector product.
+
+    Replacement is segmented LRU: entries that have been hit at least once are protected, and a
+    full cache replaces an expired entry first, then the least recently used entry that has never
+    been hit. A burst of one-off queries therefore can't push out the queries that keep repeating.
+    """
+
+    def __init__(self, dim: int, max_size: int = 1024, similarity_threshold: float = 0.97, ttl: float = 300):
+        self.max_size = max_size
+        self.similarity_threshold = similarity_threshold
+        self.ttl = ttl
+        self._matrix = np.zeros((max_size, dim), dtype=np.float32)
+        self._results = [None] * max_size
+        # Groups are stored as small integers so they can be compared in numpy.
+        self._group_ids = np.full(max_size, -1, dtype=np.int64)
+        self._groups = {}
+        self._stored_at = np.zeros(max_size)
+        self._last_used = np.zeros(max_size)
+        self._hits = np.zeros(max_size, dtype=np.int64)
+        self._count = 0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, embedding, group: Hashable) -> Optional[List[Dict]]:
+        """Return the cached results of the most similar query in `group`, or None on a miss."""
+        with self._lock:
+            group_id = self._groups.get(group)
+            if group_id is None or not self._count:
+                return None
+
+            n = self._count
+            now = time.time()
+            scores = self._matrix[:n] @ self._normalize(embedding)
+            # Entries from other groups or past their TTL can never be a hit.
+            valid = (self._group_ids[:n] == group_id) & (now - self._stored_at[:n] <= self.ttl)
+            scores[~valid] = -np.inf
+            best = int(scores.argmax())
+            if scores[best] < self.similarity_threshold:
+                return None
+
+            self._last_used[best] = now
+            self._hits[best] += 1
+            return self._results[best]
+
+    def _victim(self, now: float) -> int:
+        """Return the slot to replace in a full cache."""
+        expired = np.flatnonzero(now - self._stored_at > self.ttl)
+        if expired.size:
+            return int(expired[0])
+        # Least recently used entry of the probationary segment (never hit), if there is one.
+        last_used = np.where(self._hits == 0, self._last_used, np.inf)
+        slot = int(last_used.argmin())
+        if np.isinf(last_used[slot]):
+            # Every entry is protected, so fall back to plain LRU.
+            slot = int(self._last_used.argmin())
+        return slot
+
+    def store(self, embedding, group: Hashable, results: List[Dict]):
+        """Cache the results of a query, replacing an entry chosen by `_victim` when full."""
+        with self._lock:
+            now = time.time()
+            if self._count < self.max_size:
+                slot = self._count
+                self._count += 1
+            else:
+                slot = self._victim(now)
+
+            self._matrix[slot] = self._normalize(embedding)
+            self._results[slot] = results
+            self._group_ids[slot] = self._groups.setdefault(group, len(self._groups))
+            self._stored_at[slot] = now
+            self._last_used[slot] = now
+            self._hits[slot] = 0
@@ -1,52 +1,233 @@
 # retrieval/search.py
-from typing import List, Dict
+import functools
+from typing import List, Dict, Tuple
 from sentence_transformers import SentenceTransformer
 from qdrant_client import QdrantClient
+from qdrant_client.models import (
+    Fusion, FusionQuery, Prefetch, QuantizationSearchParams, QueryRequest, SearchParams, SparseVector
+)
 
 import config
-from ingestion.preprocessing import extract_code_features
+from ingestion.preprocessing import extract_code_features, keyword_indices
+from ingestion.vector_db import has_keyword_vectors
+from retrieval.query_cache import QueryCache
+
+# The number of characters of each retrieved sample shown in LLM prompts.
+SNIPPET_LENGTH = 500
+
+# The number of queries encoded in one forward pass by `retrieve_similar_batch`.
+QUERY_BATCH_SIZE = 64
+
+# The payload fields returned with search results: the ones the analysis and chat code read from a
+# sample's metadata. The rest (feature summaries, hashes, PE sections...) is left in Qdrant.
+RESULT_PAYLOAD_FIELDS = ["text", "file", "api_calls", "suspicious_strings", "duplicates"]
+
+# The search parameters of every dense search. The index is searched with the quantized vectors for
+# twice as many candidates as requested, which are then rescored with the original vectors.
+DENSE_SEARCH_PARAMS = SearchParams(
+    hnsw_ef=config.HNSW_EF_SEARCH,
+    exact=False,
+    quantization=QuantizationSearchParams(rescore=True, oversampling=2.0)
+)
+
+@functools.lru_cache(maxsize=1024)
+def _query_keyword_indices(query: str) -> Tuple[int, ...]:
+    """Return the sparse keyword vector indices of a query's code features.
+
+    A query that comes back (a retry, a repeated chat question) is not scanned again. The result is a
+    tuple, so the cached value can't be changed by a caller.
+    """
+    return tuple(keyword_indices(extract_code_features(query)))
 
 class MalwareSearch:
     def __init__(self, client: QdrantClient, code_embedder: SentenceTransformer):
         self.client = client
         self.code_embedder = code_embedder
+        self.query_cache = QueryCache(
+            dim=config.CODE_EMBEDDING_DIM,
+            max_size=config.QUERY_CACHE_SIZE,
+            similarity_threshold=config.QUERY_CACHE_SIMILARITY,
+            ttl=config.QUERY_CACHE_TTL
+        )
+        # Each search engine caches the embeddings of its own embedder.
+        self._embed_cached = functools.lru_cache(maxsize=config.QUERY_EMBEDDING_CACHE_SIZE)(self._encode)
+
+    @functools.cached_property
+    def keyword_vectors(self) -> bool:
+        """Whether the code collection stores keyword vectors. Checked once, on the first hybrid search."""
+        return has_keyword_vectors(self.client, config.CODE_COLLECTION)
+
+    def embed(self, query_code: str):
+        """Encode a piece of code into a dense vector with the code embedder.
+
+        The same code (a chunk seen again during bulk triage, a repeated chat question) is only
+        encoded once; recent embeddings are reused from an LRU cache.
+        """
+        return self._embed_cached(query_code)
 
-    def retrieve_similar(self, query_code: str, top_k: int = 10, filters: Dict = None) -> List[Dict]:
-        """Retrieve similar malware samples from the vector store using dense vector search."""
-        query_embedding = self.code_embedder.encode(query_code)
+    def get_cache_stats(self) -> Dict[str, float]:
+        """Return the hits, misses and hit rate of the query embedding cache."""
+        info = self._embed_cached.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            "hits": info.hits,
+            "misses": info.misses,
+            "hit_rate": info.hits / lookups if lookups else 0.0,
+            "size": info.currsize
+        }
+
+    def _encode(self, query_code: str):
+        # Passing a one-item list lets the model run its normal batched path; we take the single row back.
+        # Queries are normalized like the stored vectors, so every cosine is a plain dot product.
+        embedding = self.code_embedder.encode([query_code], batch_size=1, convert_to_numpy=True,
+                                              normalize_embeddings=True)[0]
+        # The cached array is shared by every caller, so it is made read-only.
+        embedding.flags.writeable = False
+        return embedding
+
+    @staticmethod
+    def _to_samples(hits) -> List[Dict]:
+        """Convert Qdrant search hits into the sample dicts used by the analysis code."""
+        samples = []
+        for hit in hits:
+            text = hit.payload.get("text", "")
+            samples.append({
+                "id": hit.id,
+                "score": hit.score,
+                "text": text,
+                # A short preview of the text, truncated once here so prompt builders can use it directly.
+                "snippet": text[:SNIPPET_LENGTH],
+                "metadata": hit.payload
+            })
+        return samples
+
+    def retrieve_similar(self, query_code: str, top_k: int = 10, filters: Dict = None,
+                         query_embedding=None) -> List[Dict]:
+        """Retrieve similar malware samples from the vector store using dense vector search.
+
+        A precomputed `query_embedding` can be passed to avoid encoding the same code twice.
+        Unfiltered searches for near-identical queries are answered from the query cache.
+        """
+        if query_embedding is None:
+            query_embedding = self.embed(query_code)
+
+        if filters is None:
+            cached = self.query_cache.lookup(query_embedding, top_k)
+            if cached is not None:
+                # Callers adjust scores in place, so each one gets its own copies of the results.
+                return [dict(sample) for sample in cached]
         
-        results = self.client.search(
+        results = self.client.query_points(
             collection_name=config.CODE_COLLECTION,
-            query_vector=query_embedding.tolist(),
+            # `query_points` takes the numpy array as it is.
+            query=query_embedding,
             limit=top_k,
-            query_filter=filters # An optional filter to apply to the search (e.g., only search for a specific language).
+            query_filter=filters, # An optional filter to apply to the search (e.g., only search for a specific language).
+            search_params=DENSE_SEARCH_PARAMS,
+            with_payload=RESULT_PAYLOAD_FIELDS
         )
         
-        return [
-            {
-                "score": hit.score,
-                "text": hit.payload.get("text", ""),
-                "metadata": hit.payload
-            }
-            for hit in results
+        samples = self._to_samples(results.points)
+
+        if filters is None:
+            self.query_cache.store(query_embedding, top_k, samples)
+            return [dict(sample) for sample in samples]
+        return samples
+
+    def retrieve_similar_many(self, query_embeddings, top_k: int = 10, filters: Dict = None) -> List[List[Dict]]:
+        """Run several dense searches in a single request to Qdrant, one result list per query embedding."""
+        requests = [
+            QueryRequest(query=embedding.tolist(), limit=top_k, filter=filters, params=DENSE_SEARCH_PARAMS,
+                         with_payload=RESULT_PAYLOAD_FIELDS)
+            for embedding in query_embeddings
         ]
+        results = self.client.query_batch_points(collection_name=config.CODE_COLLECTION, requests=requests)
+        return [self._to_samples(response.points) for response in results]
 
-    def hybrid_search(self, query: str, top_k: int = 20) -> List[Dict]:
-        """Combine dense (vector) and sparse (keyword) search for more relevant results."""
-        
-        # First, perform a normal vector search to find semantically similar items.
-        dense_results = self.retrieve_similar(query, top_k=top_k)
-        
-        # Next, we re-rank these initial results by giving a score boost to items
-        # that also share specific, important keywords with the query.
-        keywords = extract_code_features(query)
-        important_terms = (keywords['api_calls'] + 
-                           keywords['network_operations'] + 
-                           keywords['crypto_operations'])
-        
-        for result in dense_results:
-            metadata_text = result['metadata'].get('text', '').lower()
-            keyword_matches = sum(1 for term in important_terms if term.lower() in metadata_text)
-            result['score'] += keyword_matches * 0.1  # The `0.1` is a weighting factor.
-        
-        return sorted(dense_results, key=lambda x: x['score'], reverse=True)[:top_k//2]
+    def _encode_many(self, queries: List[str]):
+        """Encode many pieces of code in batched forward passes.
+
+        `encode` already sorts the texts by length, so each batch is padded only to similar lengths.
+        """
+        return self.code_embedder.encode(queries, batch_size=QUERY_BATCH_SIZE, convert_to_numpy=True,
+                                         normalize_embeddings=True)
+
+    def retrieve_similar_batch(self, queries: List[str], top_k: int = 10, filters: Dict = None) -> List[List[Dict]]:
+        """Retrieve similar samples for many pieces of code, one result list per query.
+
+        All queries are encoded together and searched in a single request.
+        """
+        if not queries:
+            return []
+        return self.retrieve_similar_many(self._encode_many(queries), top_k=top_k, filters=filters)
+
+    def similar_to_point(self, point_id, top_k: int = 10) -> List[Dict]:
+        """Find samples similar to one already stored in the collection.
+
+        Qdrant looks up the stored vector itself, so it is never downloaded and sent back.
+        """
+        # Passing a point id as the query makes Qdrant search with that point's stored vector.
+        results = self.client.query_points(
+            collection_name=config.CODE_COLLECTION,
+            query=point_id,
+            limit=top_k,
+            search_params=DENSE_SEARCH_PARAMS,
+            with_payload=RESULT_PAYLOAD_FIELDS
+        ).points
+        return self._to_samples(results)
+
+    def hybrid_search(self, query: str, top_k: int = 20, query_embedding=None) -> List[Dict]:
+        """Combine dense (vector) and sparse (keyword) search for more relevant results.
+
+        Qdrant runs both searches and fuses their rankings with Reciprocal Rank Fusion in a single
+        request, so the scores are fused rank scores rather than cosine similarities.
+        """
+        if query_embedding is None:
+            query_embedding = self.embed(query)
+        return self._hybrid_search_embedded([query], [query_embedding], top_k)[0]
+
+    def hybrid_search_batch(self, queries: List[str], top_k: int = 20) -> List[List[Dict]]:
+        """Run `hybrid_search` for many pieces of code, encoding them together and searching in one request."""
+        if not queries:
+            return []
+        return self._hybrid_search_embedded(queries, self._encode_many(queries), top_k)
+
+    def _hybrid_search_embedded(self, queries: List[str], query_embeddings, top_k: int) -> List[List[Dict]]:
+        """Hybrid-search already encoded queries. Cached results are reused; the rest go out in one request."""
+        results = [None] * len(queries)
+        misses = []
+        requests = []
+        for i, (query, query_embedding) in enumerate(zip(queries, query_embeddings)):
+            # The query's suspicious API calls, network operations and crypto operations, as the same
+            # sparse keyword vector that is stored with each code chunk.
+            indices = _query_keyword_indices(query)
+
+            # The same code with the same keywords always gets the same results, so they are cached too.
+            group = ("hybrid", top_k, indices)
+            cached = self.query_cache.lookup(query_embedding, group)
+            if cached is not None:
+                results[i] = [dict(sample) for sample in cached]
+                continue
+
+            prefetch = [Prefetch(query=query_embedding.tolist(), limit=top_k, params=DENSE_SEARCH_PARAMS)]
+            if indices and self.keyword_vectors:
+                prefetch.append(Prefetch(
+                    query=SparseVector(indices=list(indices), values=[1.0] * len(indices)),
+                    using=config.KEYWORD_VECTOR_NAME,
+                    limit=top_k
+                ))
+            misses.append((i, query_embedding, group))
+            requests.append(QueryRequest(
+                prefetch=prefetch,
+                query=FusionQuery(fusion=Fusion.RRF),
+                limit=top_k // 2,
+                with_payload=RESULT_PAYLOAD_FIELDS
+            ))
+
+        if requests:
+            responses = self.client.query_batch_points(collection_name=config.CODE_COLLECTION, requests=requests)
+            for (i, query_embedding, group), response in zip(misses, responses):
+                samples = self._to_samples(response.points)
+                self.query_cache.store(query_embedding, group, samples)
+                results[i] = [dict(sample) for sample in samples]
+        return results
@@ -1,17 +1,37 @@
 # utils/helpers.py
+import os
 import re
 from pathlib import Path
-from malware_rag_project import config
+from typing import Union
+import ahocorasick
+import config
 
-def extract_year_from_path(path: Path) -> int:
+# A year from 1900 to 2099. The group is non-capturing, since only the whole match is used.
+_YEAR_RE = re.compile(r'(?:19|20)\d{2}')
+
+def extract_year_from_path(path: Union[str, Path]) -> int:
     """Extract a four-digit year from a file path using a regular expression."""
-    year_match = re.search(r'(19\d{2}|20\d{2})', str(path))
-    return int(year_match.group(1)) if year_match else 2024
+    # `os.fspath` returns a str path as it is, so only Path objects are converted.
+    year_match = _YEAR_RE.search(os.fspath(path))
+    return int(year_match.group(0)) if year_match else 2024
+
+def _build_family_automaton() -> ahocorasick.Automaton:
+    """Compile the known family names into one Aho-Corasick automaton, mapping each lowercased
+    name to its position in `config.MALWARE_FAMILIES`."""
+    automaton = ahocorasick.Automaton()
+    for priority, family in enumerate(config.MALWARE_FAMILIES):
+        automaton.add_word(family.lower(), (priority, family))
+    automaton.make_automaton()
+    return automaton
+
+# Built once at import, so a path is scanned in a single pass instead of once per family.
+_FAMILY_AUTOMATON = _build_family_automaton()
 
 def extract_malware_family(file_path: str) -> str:
     """Extract a malware family name from a file path by checking for known family names."""
-    file_lower = file_path.lower()
-    for family in config.MALWARE_FAMILIES:
-        if family in file_lower:
-            return family.title()
-    return "Unknown"
+    # The automaton reports every family in the path, overlapping ones included. When a path names
+    # several families, the one listed first in the config wins.
+    matches = [entry for _, entry in _FAMILY_AUTOMATON.iter(file_path.lower())]
+    if not matches:
+        return "Unknown"
+    return min(matches)[1].title()